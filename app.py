@@ -1,27 +1,118 @@
 from dotenv import load_dotenv
 load_dotenv()
 
+import contextlib
+import hashlib
 import json
+import mmap
 import os
+import re
+import selectors
 import shlex
+import shutil
+import signal
+import stat
 import subprocess
+import sys
+import tempfile
 import threading
+import time
 import uuid
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout, as_completed
 from datetime import datetime, timezone
+from types import MappingProxyType
 from flask import Flask, request, jsonify, render_template, redirect, Response
 import anthropic
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+try:
+    import h2  # noqa: F401  (needed for http2=True)
+    HTTP2 = True
+except ImportError:
+    HTTP2 = False
+
 app = Flask(__name__)
-client = anthropic.Anthropic()
+
+# One pooled client shared by every chat: each open stream holds a connection
+# for its whole turn. Built from the SDK's own httpx classes so it matches
+# whichever httpx flavour the installed SDK uses. Idle connections are kept
+# for a minute (rather than the default 5s) so a reply typed between turns
+# reuses the warm TLS connection instead of handshaking again.
+HttpLimits = type(anthropic.DEFAULT_CONNECTION_LIMITS)
+client = anthropic.Anthropic(http_client=anthropic.DefaultHttpxClient(
+    limits=HttpLimits(max_connections=64, max_keepalive_connections=32, keepalive_expiry=60.0),
+    timeout=anthropic.Timeout(600.0, connect=10.0),
+    http2=HTTP2,
+))
 
 CHATS_DIR = os.path.join(os.path.dirname(__file__), "chats")
 os.makedirs(CHATS_DIR, exist_ok=True)
-
-# Pending tool results from the browser
-pending_results = {}   # tool_id -> result string
-pending_events = {}    # tool_id -> threading.Event
+# fsync chat files before they count as written; safer on power loss, slower
+FSYNC_WRITES = bool(os.environ.get("FSYNC_WRITES"))
+
+# run_js calls waiting on the browser; /tool_result completes the future.
+# With REDIS_URL set the result goes through a Redis list instead, so the
+# POST can land on a different worker process than the chat stream.
+pending_futures = {}   # tool_id -> concurrent.futures.Future
+REDIS_URL = os.environ.get("REDIS_URL")
+if REDIS_URL and redis is None:
+    raise RuntimeError("REDIS_URL is set but the redis package is not installed")
+redis_client = redis.Redis.from_url(REDIS_URL, decode_responses=True) if REDIS_URL else None
+TOOL_RESULT_TIMEOUT = 30
+# A result posted to Redis waits for the turn that asked for it, which may
+# still be streaming; this only reaps results nobody collects, like a post
+# that comes after its wait timed out or a worker that died mid-turn.
+REDIS_RESULT_TTL = 3600
+
+MAX_TOOL_INPUT_BYTES = 2_000_000   # a streamed tool input past this aborts the turn
+# Text deltas are coalesced into one text_delta event until this much text is
+# pending or this long has passed since the last one went out
+TEXT_FLUSH_CHARS = 256
+TEXT_FLUSH_SECONDS = 0.02
+
+# Context pruning: once a chat's estimated size passes TOKEN_BUDGET, turns
+# older than the last KEEP_TURNS are folded into a rolling summary until it is
+# back under PRUNE_TARGET, so the next few turns fit without another summary.
+# A fold that can't get there (the kept turns alone are too big) waits until
+# it can take at least PRUNE_MIN_TURNS turns at once.
+TOKEN_BUDGET = 40_000
+PRUNE_TARGET = TOKEN_BUDGET // 2
+PRUNE_MIN_TURNS = 4
+KEEP_TURNS = 12
+TOOL_RESULT_KEEP = 2048   # chars kept from each end of a long tool result
+SUMMARY_MODEL = "claude-haiku-4-5"
 
 SANDBOX_TIMEOUT = 30
+LARGE_WRITE_BYTES = 256 * 1024   # write_file payloads past this go via a host temp file
+SANDBOX_SESSION_IDLE = 600  # seconds before an idle sandbox session is closed
+# bash/grep/list_files keep only the head and tail of each output stream;
+# with the truncation note one stream stays under TOOL_RESULT_LIMIT, and bash
+# shares the limit between its stdout and stderr (see clip_output).
+TOOL_RESULT_LIMIT = 10000   # chars of a sandbox tool result sent to the model
+TOOL_OUTPUT_HEAD = 5000
+TOOL_OUTPUT_TAIL = 4000
+TOOL_OUTPUT_HARD_CAP = 64 * 1024 * 1024  # kill a command that prints more than this
+
+# Sandbox tool calls from one assistant turn run on this pool. Read-only tools
+# run concurrently; mutating tools run one at a time under the chat's lock.
+TOOL_POOL = ThreadPoolExecutor(max_workers=8)
+CONCURRENCY_SAFE = {"read_file", "list_files", "grep"}
+chat_locks = {}        # chat_id -> threading.Lock
+chat_locks_guard = threading.Lock()
+# Chats with a /chat request in progress. A second message to the same chat
+# would load the same history and append its own turn on top of it. This
+# only covers one process; see the README for running several.
+active_chats = set()
+active_chats_lock = threading.Lock()
 
 SYSTEM_PROMPT = """\
 You are a chatbot embedded in a web page. You have multiple ways to respond:
@@ -152,7 +243,10 @@ TOOLS = [
     },
     {
         "name": "grep",
-        "description": "Search for a regex pattern in files. Returns matching lines with paths and line numbers.",
+        "description": (
+            "Search for a regex pattern (Perl/Python syntax) in files. Returns matching lines "
+            "with paths and line numbers."
+        ),
         "input_schema": {
             "type": "object",
             "properties": {
@@ -164,118 +258,1185 @@ TOOLS = [
     },
 ]
 
+CACHE_CONTROL = {"type": "ephemeral"}
+
+# Cache breakpoint: the tools come before the system prompt in the prompt, so
+# this one caches both
+SYSTEM = [{"type": "text", "text": SYSTEM_PROMPT, "cache_control": CACHE_CONTROL}]
+
+# The parts of every chat request that never change. system is passed
+# separately since the rolling summary is appended to it.
+STREAM_KWARGS = MappingProxyType({
+    "model": "claude-opus-4-6",
+    "max_tokens": 16000,
+    "tools": TOOLS,
+})
+
+
+# Used for the SSE stream and for everything persisted under chats/
+if orjson:
+    dumps = orjson.dumps
+    loads = orjson.loads
+else:
+    def dumps(obj):
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode()
+    loads = json.loads
+
+
+def json_response(data):
+    return Response(dumps(data), mimetype="application/json")
+
+
+SSE_PREFIX = b"data: "
+SSE_SUFFIX = b"\n\n"
+
 
 def sse(data):
-    return f"data: {json.dumps(data)}\n\n"
+    return b"".join((SSE_PREFIX, dumps(data), SSE_SUFFIX))
 
 
-def serialize_block(block):
-    """Serialize a content block to only the fields the API accepts."""
-    if block.type == "text":
-        return {"type": "text", "text": block.text}
-    elif block.type == "tool_use":
-        return {"type": "tool_use", "id": block.id, "name": block.name, "input": block.input}
-    return block.model_dump()
+# Frames that never change, encoded once
+TEXT_START_FRAME = sse({"type": "text_start"})
+EMPTY_MESSAGE_SSE = sse({"type": "error", "content": "Empty message."}) + sse({"type": "done"})
+CHAT_BUSY_SSE = (
+    sse({"type": "error", "content": "This chat is still answering the previous message."})
+    + sse({"type": "done"})
+)
+
+# The frequent delta events only vary in their content string, so the rest of
+# the frame is spliced in around it
+TEXT_DELTA_PREFIX = b'data: {"type":"text_delta","content":'
+TOOL_DELTA_PREFIX = b'data: {"type":"tool_delta","content":'
+DELTA_SUFFIX = b"}\n\n"
+
+
+def text_delta_frame(text):
+    return b"".join((TEXT_DELTA_PREFIX, dumps(text), DELTA_SUFFIX))
+
+
+def tool_delta_frame(text):
+    return b"".join((TOOL_DELTA_PREFIX, dumps(text), DELTA_SUFFIX))
+
+
+_STRING_SPECIAL = re.compile(r'["\\]')
+
+
+class JsonStringValues:
+    """Incrementally decode the top-level string values of a streamed JSON object.
+
+    feed() takes each input_json_delta fragment and returns the newly decoded
+    text, with consecutive values separated by newlines, so tool input can be
+    shown as it arrives without re-parsing the whole buffer on every delta.
+    Keys and anything nested are skipped.
+    """
+
+    ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+    def __init__(self):
+        self.state = "outside"
+        self.depth = 0
+        self.want_value = False
+        self.started = False
+        self.hex = ""
+        self.high = None   # pending high surrogate from a \u escape
+
+    def feed(self, chunk):
+        out = []
+        i, n = 0, len(chunk)
+        while i < n:
+            state = self.state
+            if state in ("value", "skip"):
+                m = _STRING_SPECIAL.search(chunk, i)
+                end = m.start() if m else n
+                if state == "value" and end > i:
+                    out.append(chunk[i:end])
+                if not m:
+                    break
+                i = end + 1
+                self.state = "outside" if chunk[end] == '"' else state + "_esc"
+            elif state in ("value_esc", "skip_esc"):
+                base = state[:-4]
+                c = chunk[i]
+                i += 1
+                if c == "u":
+                    self.hex = ""
+                    self.state = base + "_u"
+                else:
+                    if base == "value":
+                        out.append(self.ESCAPES.get(c, c))
+                    self.state = base
+            elif state in ("value_u", "skip_u"):
+                take = min(4 - len(self.hex), n - i)
+                self.hex += chunk[i:i + take]
+                i += take
+                if len(self.hex) == 4:
+                    base = state[:-2]
+                    if base == "value":
+                        out.append(self._codepoint(int(self.hex, 16)))
+                    self.state = base
+            else:
+                c = chunk[i]
+                i += 1
+                if c == '"':
+                    if self.depth == 1 and self.want_value:
+                        if self.started:
+                            out.append("\n")
+                        self.started = True
+                        self.state = "value"
+                    else:
+                        self.state = "skip"
+                elif c in "{[":
+                    self.depth += 1
+                elif c in "}]":
+                    self.depth -= 1
+                elif self.depth == 1 and c == ":":
+                    self.want_value = True
+                elif self.depth == 1 and c == ",":
+                    self.want_value = False
+        return "".join(out)
+
+    def _codepoint(self, code):
+        if 0xD800 <= code < 0xDC00:
+            self.high = code
+            return ""
+        high, self.high = self.high, None
+        if high is not None and 0xDC00 <= code < 0xE000:
+            return chr(0x10000 + ((high - 0xD800) << 10) + (code - 0xDC00))
+        if 0xD800 <= code < 0xE000:
+            return "\ufffd"
+        return chr(code)
+
+
+def with_cache_breakpoints(messages):
+    """Return a copy of messages with cache breakpoints on the last two user turns.
+
+    The newest one writes the cache for the next request; the one before it
+    reads what the previous request wrote. With the system prompt and summary
+    breakpoints that's the API's limit of four. messages itself is not modified.
+    """
+    out = list(messages)
+    marked = 0
+    for i in range(len(out) - 1, -1, -1):
+        if marked == 2:
+            break
+        msg = out[i]
+        if msg["role"] != "user":
+            continue
+        content = msg["content"]
+        if isinstance(content, str):
+            content = [{"type": "text", "text": content}]
+        content = content[:-1] + [{**content[-1], "cache_control": CACHE_CONTROL}]
+        out[i] = {**msg, "content": content}
+        marked += 1
+    return out
+
+
+# Chats are stored as {id}.jsonl, an append-only log of typed records: a
+# session_metadata header, then one "message" record per message. The title
+# in the header is final, since it comes from the first user message.
+# {id}.json is the old single-file format; it is still read, and replaced by a
+# log on the chat's next save.
+last_saved_index = {}   # chat_id -> number of messages already in the .jsonl
+
+# Parsed messages of recently used chats, so a new turn doesn't re-read the
+# whole log. Entries are checked against the log's mtime and size to catch
+# writes from elsewhere; the oldest is dropped past HISTORY_CACHE_SIZE.
+history_cache = {}      # chat_id -> ((mtime_ns, size), messages)
+HISTORY_CACHE_SIZE = 32
+
+# Titles come from the first user message, which never changes once there,
+# so each chat's is only looked up until it's found.
+title_cache = {}        # chat_id -> title
+NEW_CHAT_TITLE = "New chat"
+
+# id/title/updated_at for every chat, kept in memory and mirrored to
+# chats/index.json so listing chats doesn't have to open each one. The mtime
+# each entry was read at lets a listing re-read only the files that changed
+# since (e.g. saved by another server process).
+CHATS_INDEX = {}        # chat_id -> {"id", "title", "updated_at"}
+index_mtimes = {}       # chat_id -> mtime of the chat file CHATS_INDEX was read from
+index_lock = threading.RLock()
+# The encoded /chats response and its ETag, built on demand and dropped
+# whenever the index changes. Guarded by index_lock.
+listing_cache = None    # (body, etag) or None
+
+
+def chat_dir(chat_id):
+    """Chat files are sharded by the first two characters of the id."""
+    return os.path.join(CHATS_DIR, chat_id[:2])
 
 
 def chat_path(chat_id):
-    return os.path.join(CHATS_DIR, f"{chat_id}.json")
+    return os.path.join(chat_dir(chat_id), f"{chat_id}.jsonl")
 
 
-def save_chat(chat_id, messages):
-    title = "New chat"
+def legacy_chat_path(chat_id):
+    return os.path.join(chat_dir(chat_id), f"{chat_id}.json")
+
+
+def atomic_write(path, data):
+    """Replace path with data so readers see either the old file or the new one."""
+    tmp = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+    try:
+        with open(tmp, "wb") as f:
+            f.write(data)
+            if FSYNC_WRITES:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp)
+        raise
+
+
+def chat_title(messages):
     for msg in messages:
         if msg["role"] == "user" and isinstance(msg["content"], str):
-            title = msg["content"][:80]
+            return msg["content"][:80]
+    return NEW_CHAT_TITLE
+
+
+def save_chat(chat_id, messages):
+    start = last_saved_index.get(chat_id, 0)
+    if start == len(messages):
+        # Nothing new; leave the file (and its mtime) alone
+        return
+    title = title_cache.get(chat_id)
+    if title is None:
+        title = chat_title(messages)
+        if title != NEW_CHAT_TITLE:
+            title_cache[chat_id] = title
+    now = datetime.now(timezone.utc).isoformat()
+    records = []
+    if start == 0:
+        records.append({"type": "session_metadata", "id": chat_id, "title": title, "updated_at": now})
+    records.extend({"type": "message", "content": msg} for msg in messages[start:])
+    if start == 0:
+        os.makedirs(chat_dir(chat_id), exist_ok=True)
+    data = b"".join(dumps(rec) + b"\n" for rec in records)
+    if start == 0:
+        atomic_write(chat_path(chat_id), data)
+    else:
+        with open(chat_path(chat_id), "a+b") as f:
+            trim_torn_tail(f)
+            f.write(data)
+            if FSYNC_WRITES:
+                f.flush()
+                os.fsync(f.fileno())
+    last_saved_index[chat_id] = len(messages)
+    cache_history(chat_id, log_version(chat_id), messages)
+    if start == 0 and os.path.exists(legacy_chat_path(chat_id)):
+        os.remove(legacy_chat_path(chat_id))
+    with index_lock:
+        CHATS_INDEX[chat_id] = {"id": chat_id, "title": title, "updated_at": now}
+        index_mtimes[chat_id] = os.path.getmtime(chat_path(chat_id))
+        invalidate_listing()
+    persist_index()
+
+
+def trim_torn_tail(f):
+    """Cut an interrupted append off the end of a log opened "a+b".
+
+    Every record ends in a newline, so anything after the last one is a
+    partial write. Only save_chat calls this, just before it appends.
+    """
+    end = pos = f.seek(0, os.SEEK_END)
+    while pos > 0:
+        start = max(0, pos - 4096)
+        f.seek(start)
+        i = f.read(pos - start).rfind(b"\n")
+        if i != -1:
+            pos = start + i + 1
             break
-    data = {
-        "id": chat_id,
-        "title": title,
-        "updated_at": datetime.now(timezone.utc).isoformat(),
-        "messages": messages,
-    }
-    with open(chat_path(chat_id), "w") as f:
-        json.dump(data, f)
+        pos = start
+    if pos != end:
+        f.truncate(pos)
+
+
+def read_chat_log(chat_id):
+    """Yield the records of the chat's log, stopping at a torn last line.
+
+    A line without its newline, or one that doesn't parse, is an append that
+    was interrupted or is still being written. Readers leave it alone; the
+    next save_chat trims it before appending.
+    """
+    with open(chat_path(chat_id), "rb") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                rec = loads(line)
+            except json.JSONDecodeError:
+                break
+            yield rec
+
+
+def log_version(chat_id):
+    st = os.stat(chat_path(chat_id))
+    return st.st_mtime_ns, st.st_size
+
+
+def cache_history(chat_id, version, messages):
+    history_cache.pop(chat_id, None)
+    history_cache[chat_id] = (version, list(messages))
+    while len(history_cache) > HISTORY_CACHE_SIZE:
+        history_cache.pop(next(iter(history_cache)), None)
 
 
 def load_messages(chat_id):
+    """Return a new list of the chat's messages; callers may append to it."""
+    try:
+        version = log_version(chat_id)
+    except FileNotFoundError:
+        legacy = legacy_chat_path(chat_id)
+        last_saved_index[chat_id] = 0
+        if not os.path.exists(legacy):
+            return []
+        with open(legacy, "rb") as f:
+            return loads(f.read()).get("messages", [])
+    cached = history_cache.get(chat_id)
+    if cached and cached[0] == version:
+        last_saved_index[chat_id] = len(cached[1])
+        return list(cached[1])
+    messages = []
+    for rec in read_chat_log(chat_id):
+        if rec.get("type") == "message":
+            messages.append(rec["content"])
+    last_saved_index[chat_id] = len(messages)
+    cache_history(chat_id, version, messages)
+    return messages
+
+
+# Legacy .json chats were written with the metadata keys before "messages"
+LEGACY_MESSAGES_KEY = b', "messages":'
+
+
+def read_legacy_meta(path):
+    with open(path, "rb") as f:
+        head = f.read(4096)
+        end = head.find(LEGACY_MESSAGES_KEY)
+        if end != -1:
+            data = loads(head[:end] + b"}")
+        else:
+            data = loads(head + f.read())
+    return {
+        "id": data["id"],
+        "title": data.get("title", "Untitled"),
+        "updated_at": data.get("updated_at", ""),
+    }
+
+
+def load_meta(chat_id):
     path = chat_path(chat_id)
     if not os.path.exists(path):
-        return []
-    with open(path) as f:
-        return json.load(f).get("messages", [])
+        path = legacy_chat_path(chat_id)
+        if not os.path.exists(path):
+            return None
+        return read_legacy_meta(path)
+    with open(path, "rb") as f:
+        header = loads(f.readline())
+    meta = {"id": chat_id, "title": header["title"]}
+    # The log is appended to on every save, so its mtime is the last update
+    mtime = os.path.getmtime(path)
+    meta["updated_at"] = datetime.fromtimestamp(mtime, timezone.utc).isoformat()
+    return meta
+
+
+# Overlaps the per-chat file reads when the index has to be rebuilt
+_LIST_POOL = ThreadPoolExecutor(max_workers=8)
+
+
+def index_path():
+    return os.path.join(CHATS_DIR, "index.json")
+
+
+index_write_lock = threading.Lock()   # keeps snapshots landing in order
+
+
+def write_index():
+    with index_write_lock:
+        with index_lock:
+            data = dumps({"chats": CHATS_INDEX, "mtimes": index_mtimes})
+        atomic_write(index_path(), data)
+
+
+def invalidate_listing():
+    global listing_cache
+    with index_lock:
+        listing_cache = None
+
+
+def persist_index():
+    """Write the index in the background so requests don't wait on it."""
+    threading.Thread(target=write_index, daemon=True).start()
+
+
+def scan_shard(shard):
+    """Return ({chat_id: mtime} of logs, {chat_id: mtime} of legacy chats)."""
+    logs, legacy = {}, {}
+    with os.scandir(shard) as it:
+        for entry in it:
+            fname = entry.name
+            if fname.endswith(".jsonl"):
+                chat_id, found = fname[:-len(".jsonl")], logs
+            elif fname.endswith(".json"):
+                # Skip {id}.summary.json
+                chat_id, found = fname[:-len(".json")], legacy
+                if "." in chat_id:
+                    continue
+            else:
+                continue
+            try:
+                found[chat_id] = entry.stat().st_mtime
+            except FileNotFoundError:
+                pass
+    return logs, legacy
+
+
+def refresh_index():
+    """Bring the index in line with the chat files on disk.
+
+    Files whose mtime matches the index are skipped; new and changed ones
+    are re-read, and entries whose file is gone are dropped. Both the shard
+    scans and the reads run on _LIST_POOL.
+    """
+    with os.scandir(CHATS_DIR) as it:
+        shards = [entry.path for entry in it if entry.is_dir()]
+    on_disk = {}
+    for logs, legacy in _LIST_POOL.map(scan_shard, shards):
+        on_disk.update(legacy)
+        on_disk.update(logs)
+    with index_lock:
+        changed = [c for c, mtime in on_disk.items() if index_mtimes.get(c) != mtime]
+        gone = [c for c in CHATS_INDEX if c not in on_disk]
+    if not changed and not gone:
+        return
+    futures = [_LIST_POOL.submit(load_meta, chat_id) for chat_id in changed]
+    metas = []
+    for fut in futures:
+        try:
+            metas.append(fut.result())
+        except (OSError, ValueError, KeyError):
+            # One unreadable file shouldn't take the whole listing down
+            metas.append(None)
+    with index_lock:
+        for chat_id in gone:
+            CHATS_INDEX.pop(chat_id, None)
+            index_mtimes.pop(chat_id, None)
+        for chat_id, meta in zip(changed, metas):
+            if meta:
+                CHATS_INDEX[chat_id] = meta
+                index_mtimes[chat_id] = on_disk[chat_id]
+        invalidate_listing()
+    persist_index()
+
+
+def shard_chats():
+    """Move chat files left in the top level of CHATS_DIR into their shards."""
+    with os.scandir(CHATS_DIR) as it:
+        for entry in it:
+            chat_id = entry.name.split(".", 1)[0]
+            if chat_id == "index" or not entry.name.endswith((".jsonl", ".json")) \
+                    or not entry.is_file():
+                continue
+            os.makedirs(chat_dir(chat_id), exist_ok=True)
+            os.replace(entry.path, os.path.join(chat_dir(chat_id), entry.name))
+
+
+def load_index():
+    """Load the saved chat index and bring it up to date."""
+    global CHATS_INDEX, index_mtimes
+    shard_chats()
+    with index_lock:
+        try:
+            with open(index_path(), "rb") as f:
+                data = loads(f.read())
+            CHATS_INDEX, index_mtimes = data["chats"], data["mtimes"]
+        except (OSError, ValueError, KeyError, TypeError):
+            CHATS_INDEX, index_mtimes = {}, {}
+    refresh_index()
+
 
+def summary_path(chat_id):
+    return os.path.join(chat_dir(chat_id), f"{chat_id}.summary.json")
 
-def sandbox_exec(chat_id, args, input_data=None, timeout=SANDBOX_TIMEOUT):
-    """Run a command inside the chat's sandbox."""
-    cmd = ["sandbox", "--name", f"chat-{chat_id}", "--net=host"] + args
+
+def load_summary(chat_id):
+    """Return (upto, text): messages[:upto] are covered by the summary text."""
+    path = summary_path(chat_id)
+    if not os.path.exists(path):
+        return 0, ""
+    with open(path, "rb") as f:
+        data = loads(f.read())
+    return data["upto"], data["text"]
+
+
+def summarize(previous, messages):
+    """Fold messages into the previous rolling summary using a cheap model."""
+    prompt = (
+        "Update the running summary of a conversation between a user and an "
+        "assistant that can run JavaScript in the user's browser and commands in "
+        "a Linux sandbox. Keep facts, decisions, file paths, and the current state "
+        "of the page and sandbox; drop chit-chat.\n\n"
+        f"<summary>\n{previous}\n</summary>\n\n"
+        f"<new_messages>\n{json.dumps(messages)}\n</new_messages>\n\n"
+        "Reply with the updated summary only."
+    )
+    response = client.messages.create(
+        model=SUMMARY_MODEL,
+        max_tokens=2048,
+        messages=[{"role": "user", "content": prompt}],
+    )
+    return "".join(b.text for b in response.content if b.type == "text")
+
+
+def truncate_tool_results(msg):
+    """Elide the middle of long tool results, keeping both ends."""
+    content = msg["content"]
+    if msg["role"] != "user" or isinstance(content, str):
+        return msg
+    blocks = []
+    for block in content:
+        text = block.get("content")
+        if block["type"] == "tool_result" and isinstance(text, str) \
+                and len(text) > 2 * TOOL_RESULT_KEEP:
+            block = {**block, "content": (
+                text[:TOOL_RESULT_KEEP] + "\n... (elided) ...\n" + text[-TOOL_RESULT_KEEP:]
+            )}
+        blocks.append(block)
+    return {**msg, "content": blocks}
+
+
+def prune_messages(chat_id, messages):
+    """Return (system, messages) to send, folding old turns into a summary.
+
+    Sizes are estimated at ~4 characters per token. The cut is always at the
+    start of a user turn so tool_use/tool_result pairs stay together, and the
+    summary only ever grows by the turns between its old and new cut. Cuts go
+    down to PRUNE_TARGET, well under TOKEN_BUDGET, so they (and the cache
+    misses they cause) happen once every several turns rather than on every
+    one. The last KEEP_TURNS turns are never folded, so when they alone pass
+    the budget the context stays over it, and a partial fold is only made
+    once it covers PRUNE_MIN_TURNS turns.
+    """
+    msgs = [truncate_tool_results(m) for m in messages]
+    upto, summary = load_summary(chat_id)
+
+    sizes = [len(dumps(m)) // 4 for m in msgs]
+    remaining = sum(sizes[upto:])
+    turn_starts = [
+        i for i, m in enumerate(msgs)
+        if m["role"] == "user" and isinstance(m["content"], str)
+    ]
+    limit = turn_starts[-KEEP_TURNS] if len(turn_starts) > KEEP_TURNS else 0
+    cut = upto
+    target = PRUNE_TARGET if remaining > TOKEN_BUDGET else remaining
+    for start in turn_starts:
+        if remaining <= target or start > limit:
+            break
+        if start <= cut:
+            continue
+        remaining -= sum(sizes[cut:start])
+        cut = start
+    folded = sum(1 for start in turn_starts if upto < start <= cut)
+    if remaining > target and folded < PRUNE_MIN_TURNS:
+        cut = upto
+
+    if cut > upto:
+        try:
+            summary = summarize(summary, msgs[upto:cut])
+        except anthropic.APIError:
+            cut = upto
+        else:
+            upto = cut
+            os.makedirs(chat_dir(chat_id), exist_ok=True)
+            atomic_write(summary_path(chat_id), dumps({"upto": upto, "text": summary}))
+
+    system = SYSTEM
+    if summary:
+        # Own breakpoint: the summary only changes when more turns are folded
+        # in, so it stays cached while the turns after it change
+        system = SYSTEM + [{
+            "type": "text",
+            "text": f"Summary of the earlier part of this conversation:\n{summary}",
+            "cache_control": CACHE_CONTROL,
+        }]
+    return system, msgs[upto:]
+
+
+def sandbox_command(chat_id, args):
+    return ["sandbox", "--name", f"chat-{chat_id}", "--net=host"] + args
+
+
+def kill_process_group(proc):
     try:
-        result = subprocess.run(
-            cmd, input=input_data, capture_output=True, text=True, timeout=timeout,
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    proc.wait()
+
+
+class OutputBuffer:
+    """Collects a command's output as it is read.
+
+    A bounded buffer keeps only the first TOOL_OUTPUT_HEAD and last
+    TOOL_OUTPUT_TAIL bytes and counts the rest, so memory stays flat however
+    much the command prints.
+    """
+
+    def __init__(self, bounded=False):
+        self.bounded = bounded
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.total = 0
+
+    def extend(self, chunk):
+        self.total += len(chunk)
+        if not self.bounded:
+            self.head += chunk
+            return
+        room = TOOL_OUTPUT_HEAD - len(self.head)
+        if room > 0:
+            self.head += chunk[:room]
+            chunk = chunk[room:]
+        self.tail += chunk
+        if len(self.tail) > TOOL_OUTPUT_TAIL:
+            del self.tail[:-TOOL_OUTPUT_TAIL]
+
+    def drop_last(self, n):
+        """Forget the last n bytes read (a trailing marker)."""
+        self.total -= n
+        k = min(n, len(self.tail))
+        del self.tail[len(self.tail) - k:]
+        del self.head[len(self.head) - (n - k):]
+
+    @property
+    def over_cap(self):
+        return self.bounded and self.total > TOOL_OUTPUT_HARD_CAP
+
+    def getvalue(self):
+        skipped = self.total - len(self.head) - len(self.tail)
+        if skipped <= 0:
+            return (self.head + self.tail).decode(errors="replace")
+        return (
+            self.head.decode(errors="replace")
+            + f"\n... ({skipped} bytes truncated) ...\n"
+            + self.tail.decode(errors="replace")
         )
-        return result.stdout, result.stderr, result.returncode
+
+
+def output_limit_result(out, err, code=-signal.SIGKILL):
+    """Result tuple for a command killed for printing too much."""
+    stdout = out.getvalue() + "\n(output limit exceeded, command killed)"
+    return stdout, err.getvalue(), code
+
+
+def drain_pipe(proc, pipe, buf):
+    """Read pipe into buf until EOF, killing proc if buf goes over its cap."""
+    fd = pipe.fileno()
+    while chunk := os.read(fd, 65536):
+        buf.extend(chunk)
+        if buf.over_cap:
+            kill_process_group(proc)
+            break
+    pipe.close()
+
+
+def feed_pipe(pipe, data):
+    try:
+        if data:
+            pipe.write(data)
+    except BrokenPipeError:
+        pass
+    finally:
+        try:
+            pipe.close()
+        except BrokenPipeError:
+            pass
+
+
+def sandbox_exec_oneshot(chat_id, args, input_data=None, timeout=SANDBOX_TIMEOUT, bounded=False):
+    """Run a command in a fresh sandbox process.
+
+    The sandbox gets its own process group so a timeout kills everything it
+    started; otherwise a leftover background job keeps the output pipes open
+    and the tool thread waits on it. Output is read by threads as it arrives
+    (see OutputBuffer for bounded).
+    """
+    proc = subprocess.Popen(
+        sandbox_command(chat_id, args), stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE, start_new_session=True,
+    )
+    out, err = OutputBuffer(bounded), OutputBuffer(bounded)
+    threads = [
+        threading.Thread(target=feed_pipe, args=(proc.stdin, input_data), daemon=True),
+        threading.Thread(target=drain_pipe, args=(proc, proc.stdout, out), daemon=True),
+        threading.Thread(target=drain_pipe, args=(proc, proc.stderr, err), daemon=True),
+    ]
+    for t in threads:
+        t.start()
+    deadline = time.monotonic() + timeout
+    for t in threads[1:]:
+        t.join(max(0, deadline - time.monotonic()))
+    if any(t.is_alive() for t in threads[1:]):
+        kill_process_group(proc)
+        for t in threads[1:]:
+            t.join()
+        return "", "Command timed out", 1
+    proc.wait()
+    if out.over_cap or err.over_cap:
+        return output_limit_result(out, err, proc.returncode)
+    return out.getvalue(), err.getvalue(), proc.returncode
+
+
+class SandboxSessionError(Exception):
+    """The session broke. started says whether the command may have run."""
+
+    def __init__(self, message, started=True):
+        super().__init__(message)
+        self.started = started
+
+
+class OutputLimitExceeded(Exception):
+    def __init__(self, out, err):
+        super().__init__("output limit exceeded")
+        self.out, self.err = out, err
+
+
+class SandboxSession:
+    """A long-lived bash inside a chat's sandbox, fed one command at a time.
+
+    Each command is written to the shell's stdin followed by a marker line on
+    stdout (carrying the exit code) and on stderr, so the output of one command
+    can be read back without restarting the sandbox. Input data is sent right
+    after the command line and copied to a temp file by `head -c` before the
+    command runs, so the shell never parses it.
+    """
+
+    def __init__(self, chat_id):
+        self.proc = subprocess.Popen(
+            sandbox_command(chat_id, ["bash"]),
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            start_new_session=True,
+        )
+        self.lock = threading.Lock()
+        self.last_used = time.monotonic()
+
+    def run(self, args, input_data=None, timeout=SANDBOX_TIMEOUT, bounded=False):
+        """Run args in the session. Caller must hold self.lock."""
+        marker = uuid.uuid4().hex
+        cmd = shlex.join(args)
+        if input_data is None:
+            script = f"{cmd} < /dev/null; rc=$?"
+            payload = b""
+        else:
+            payload = input_data
+            script = (
+                f'f=$(mktemp); head -c {len(payload)} > "$f"; '
+                f'{cmd} < "$f"; rc=$?; rm -f "$f"'
+            )
+        script += f"; printf '\\n{marker} %s\\n' $rc; printf '\\n{marker}\\n' >&2\n"
+        try:
+            self.proc.stdin.write(script.encode() + payload)
+            self.proc.stdin.flush()
+        except (OSError, ValueError) as e:
+            # Nothing reached a live shell, so the command never ran
+            raise SandboxSessionError(f"sandbox session closed: {e}", started=False)
+
+        out, err = OutputBuffer(bounded), OutputBuffer(bounded)
+        # The markers are looked for in a short window over the latest bytes,
+        # since a bounded buffer doesn't keep everything
+        out_scan, err_scan = bytearray(), bytearray()
+        out_end = f"\n{marker} ".encode()
+        err_end = f"\n{marker}\n".encode()
+        code = None
+        err_done = False
+        deadline = time.monotonic() + timeout
+        with selectors.DefaultSelector() as sel:
+            sel.register(self.proc.stdout, selectors.EVENT_READ, (out, out_scan))
+            sel.register(self.proc.stderr, selectors.EVENT_READ, (err, err_scan))
+            while code is None or not err_done:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise subprocess.TimeoutExpired(cmd, timeout)
+                for key, _ in sel.select(remaining):
+                    chunk = os.read(key.fd, 65536)
+                    if not chunk:
+                        raise SandboxSessionError("sandbox session exited")
+                    buf, scan = key.data
+                    buf.extend(chunk)
+                    scan += chunk
+                if out.over_cap or err.over_cap:
+                    raise OutputLimitExceeded(out, err)
+                if code is None:
+                    i = out_scan.find(out_end)
+                    j = out_scan.find(b"\n", i + len(out_end)) if i != -1 else -1
+                    if j != -1:
+                        code = int(out_scan[i + len(out_end):j])
+                        out.drop_last(len(out_scan) - i)
+                    elif i == -1:
+                        del out_scan[:-len(out_end)]
+                if not err_done:
+                    i = err_scan.find(err_end)
+                    if i != -1:
+                        err.drop_last(len(err_scan) - i)
+                        err_done = True
+                    else:
+                        del err_scan[:-len(err_end)]
+        self.last_used = time.monotonic()
+        return out.getvalue(), err.getvalue(), code
+
+    def close(self):
+        try:
+            self.proc.stdin.close()
+        except OSError:
+            pass
+        kill_process_group(self.proc)
+        self.proc.stdout.close()
+        self.proc.stderr.close()
+
+
+sandbox_sessions = {}      # chat_id -> SandboxSession
+sandbox_sessions_lock = threading.Lock()
+starting_sessions = set()  # chats whose session is being started
+no_session_chats = set()   # chats whose sandbox couldn't host a session
+
+
+def get_sandbox_session(chat_id):
+    """The chat's session, starting one if needed; None to run one-shot.
+
+    The session is started outside sandbox_sessions_lock so a slow sandbox
+    only holds up its own chat; calls for that chat made while it starts
+    run one-shot instead of waiting.
+    """
+    with sandbox_sessions_lock:
+        session = sandbox_sessions.get(chat_id)
+        if session or chat_id in no_session_chats or chat_id in starting_sessions:
+            return session
+        starting_sessions.add(chat_id)
+    session = None
+    try:
+        session = SandboxSession(chat_id)
+        with session.lock:
+            session.run(["true"], timeout=SANDBOX_TIMEOUT)
+    except (OSError, SandboxSessionError, subprocess.TimeoutExpired, ValueError):
+        if session is not None:
+            session.close()
+        with sandbox_sessions_lock:
+            starting_sessions.discard(chat_id)
+            no_session_chats.add(chat_id)
+        return None
+    with sandbox_sessions_lock:
+        starting_sessions.discard(chat_id)
+        if not sandbox_sessions:
+            schedule_sandbox_sweep()
+        sandbox_sessions[chat_id] = session
+    return session
+
+
+def drop_sandbox_session(chat_id, session):
+    with sandbox_sessions_lock:
+        if sandbox_sessions.get(chat_id) is session:
+            del sandbox_sessions[chat_id]
+    session.close()
+
+
+def schedule_sandbox_sweep():
+    timer = threading.Timer(60, sweep_sandbox_sessions)
+    timer.daemon = True
+    timer.start()
+
+
+def sweep_sandbox_sessions():
+    """Close sessions that have sat idle; keep sweeping while any remain."""
+    now = time.monotonic()
+    with sandbox_sessions_lock:
+        idle = [
+            (chat_id, s) for chat_id, s in sandbox_sessions.items()
+            if now - s.last_used > SANDBOX_SESSION_IDLE and not s.lock.locked()
+        ]
+    for chat_id, session in idle:
+        # Skip a session that was picked up since the check above
+        if session.lock.acquire(blocking=False):
+            try:
+                drop_sandbox_session(chat_id, session)
+            finally:
+                session.lock.release()
+    with sandbox_sessions_lock:
+        if sandbox_sessions:
+            schedule_sandbox_sweep()
+
+
+def sandbox_exec(chat_id, args, input_data=None, timeout=SANDBOX_TIMEOUT, bounded=False):
+    """Run a command inside the chat's sandbox. input_data is bytes.
+
+    Uses the chat's persistent session when it's free; concurrent calls and
+    sandboxes without session support fall back to a one-shot process.
+    bounded keeps only the head and tail of the output (see OutputBuffer).
+    """
+    session = get_sandbox_session(chat_id)
+    if session is None or not session.lock.acquire(blocking=False):
+        return sandbox_exec_oneshot(chat_id, args, input_data, timeout, bounded)
+    try:
+        return session.run(args, input_data, timeout, bounded)
     except subprocess.TimeoutExpired:
+        drop_sandbox_session(chat_id, session)
         return "", "Command timed out", 1
+    except OutputLimitExceeded as e:
+        drop_sandbox_session(chat_id, session)
+        return output_limit_result(e.out, e.err)
+    except (SandboxSessionError, ValueError) as e:
+        drop_sandbox_session(chat_id, session)
+        if isinstance(e, SandboxSessionError) and not e.started:
+            return sandbox_exec_oneshot(chat_id, args, input_data, timeout, bounded)
+        # The command may have run already; running it again could repeat it
+        return "", f"Sandbox session failed: {e}", 1
+    finally:
+        session.lock.release()
+
+
+sandbox_upper_dirs = {}   # chat_id -> host path of the sandbox's overlay upper dir, or None
+
+
+def sandbox_upper_dir(chat_id):
+    """Ask the sandbox where its overlay upper dir lives on the host.
+
+    The answer is cached once the sandbox gives one, including "no upper dir"
+    from a sandbox without --upperdir; a call that fails or times out is
+    retried next time.
+    """
+    if chat_id not in sandbox_upper_dirs:
+        try:
+            result = subprocess.run(
+                ["sandbox", "--name", f"chat-{chat_id}", "--upperdir"],
+                capture_output=True, text=True, timeout=SANDBOX_TIMEOUT,
+            )
+        except (OSError, subprocess.TimeoutExpired):
+            return None
+        upper = None
+        if result.returncode == 0 and os.path.isdir(result.stdout.strip()):
+            upper = os.path.realpath(result.stdout.strip())
+        sandbox_upper_dirs[chat_id] = upper
+    return sandbox_upper_dirs[chat_id]
+
+
+def open_upper_file(chat_id, path, write=False):
+    """Open a sandbox file that lives in the overlay upper dir, else return None.
+
+    Files in the upper dir are the ones the sandbox has created or modified,
+    and the upper copy is what the sandbox sees, so they can be read and
+    written in place directly. The path is walked one component at a time
+    with O_NOFOLLOW, so a symlink the sandbox swaps in can't point the open
+    outside the upper dir. Anything else (relative paths, which depend on the
+    sandbox's working directory, files only in the lower layer, whiteouts,
+    symlinks, non-regular files) goes through the sandbox.
+    Returns a binary file object; with write=True it is opened for writing
+    and truncated, keeping its inode and mode like `cat >`.
+    """
+    if not os.path.isabs(path):
+        return None
+    upper = sandbox_upper_dir(chat_id)
+    if upper is None:
+        return None
+    parts = [p for p in os.path.normpath(path).split("/") if p]
+    if not parts:
+        return None
+    fd = None
+    try:
+        fd = os.open(upper, os.O_RDONLY | os.O_DIRECTORY)
+        for part in parts[:-1]:
+            next_fd = os.open(part, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW, dir_fd=fd)
+            os.close(fd)
+            fd = next_fd
+        # O_NONBLOCK so a FIFO can't hang the open; it's refused below
+        flags = (os.O_WRONLY if write else os.O_RDONLY) | os.O_NOFOLLOW | os.O_NONBLOCK
+        file_fd = os.open(parts[-1], flags, dir_fd=fd)
+    except OSError:
+        return None
+    finally:
+        if fd is not None:
+            os.close(fd)
+    try:
+        if not stat.S_ISREG(os.fstat(file_fd).st_mode):
+            os.close(file_fd)
+            return None
+        if write:
+            os.ftruncate(file_fd, 0)
+    except OSError:
+        os.close(file_fd)
+        return None
+    return os.fdopen(file_fd, "wb" if write else "rb")
+
+
+def read_sandbox_file(chat_id, path):
+    """Return (content, error) for a file in the chat's sandbox."""
+    f = open_upper_file(chat_id, path)
+    if f:
+        try:
+            with f:
+                return f.read().decode(errors="replace"), None
+        except OSError:
+            pass
+    stdout, stderr, code = sandbox_exec(chat_id, ["cat", path])
+    if code != 0:
+        return None, stderr.strip()
+    return stdout, None
+
+
+def write_sandbox_file(chat_id, path, content):
+    """Write a file in the chat's sandbox, creating parent dirs. Returns an error or None."""
+    data = content.encode()
+    f = open_upper_file(chat_id, path, write=True)
+    if f:
+        try:
+            with f:
+                f.write(data)
+            return None
+        except OSError:
+            pass
+    safe_path = shlex.quote(path)
+    mkdir = f"mkdir -p \"$(dirname {safe_path})\""
+    if len(data) > LARGE_WRITE_BYTES:
+        # Hand big payloads over as a host temp file the sandbox can read
+        # through its overlay, instead of pushing them through a pipe.
+        with tempfile.NamedTemporaryFile(prefix="reflect-write-") as tmp:
+            tmp.write(data)
+            tmp.flush()
+            stdout, stderr, code = sandbox_exec(
+                chat_id, ["sh", "-c", f"{mkdir} && cat {shlex.quote(tmp.name)} > {safe_path}"],
+            )
+        if code == 0:
+            return None
+    stdout, stderr, code = sandbox_exec(
+        chat_id, ["sh", "-c", f"{mkdir} && cat > {safe_path}"], input_data=data,
+    )
+    if code != 0:
+        return stderr.strip()
+    return None
+
+
+def grep_file(regex, f, path):
+    """grep -n for one open file: regex is searched over an mmap of it.
+
+    Matches are confirmed against their own line, so patterns that could span
+    newlines behave like grep's line-at-a-time matching.
+    """
+    with f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return ""
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            binary = buf.find(b"\0", 0, 8192) != -1
+            # A trailing newline ends the last line rather than starting a new one
+            limit = len(buf) - 1 if buf[-1] == ord("\n") else len(buf)
+            lines = []
+            lineno, counted, pos = 1, 0, 0
+            while True:
+                m = regex.search(buf, pos, limit)
+                if not m:
+                    break
+                start = buf.rfind(b"\n", 0, m.start()) + 1
+                end = buf.find(b"\n", m.start(), limit)
+                if end == -1:
+                    end = limit
+                if regex.search(buf, start, end):
+                    if binary:
+                        return f"Binary file {path} matches"
+                    lineno += buf[counted:start].count(b"\n")
+                    counted = start
+                    lines.append(f"{lineno}:{buf[start:end].decode(errors='replace')}")
+                if end >= limit:
+                    break
+                pos = end + 1
+            return "\n".join(lines)
+
+
+grep_perl = {}   # chat_id -> whether the sandbox's grep takes -P
+
+
+def grep_supports_perl(chat_id):
+    """Check once per chat whether grep has -P (GNU grep built with PCRE).
+
+    An empty pattern over /dev/null exits 1 (no match) when -P works and 2
+    when the flag is unknown.
+    """
+    if chat_id not in grep_perl:
+        stdout, stderr, code = sandbox_exec(chat_id, ["grep", "-P", "", "/dev/null"])
+        grep_perl[chat_id] = code == 1 and not stderr
+    return grep_perl[chat_id]
+
+
+def clip_middle(text, n):
+    """Keep the first and last n/2 chars of text, noting how much was cut."""
+    if len(text) <= n:
+        return text
+    half = n // 2
+    return f"{text[:half]}\n... ({len(text) - 2 * half} chars truncated) ...\n{text[-half:]}"
+
+
+def clip_output(stdout, stderr):
+    """Join stdout and stderr into one result under TOOL_RESULT_LIMIT.
+
+    stderr gets at least half the room when both are long, so the error
+    from a noisy failing command isn't what the final cut drops.
+    """
+    room = TOOL_RESULT_LIMIT - 200   # for the truncation notes
+    if len(stdout) + len(stderr) > room:
+        err_room = min(len(stderr), max(room // 2, room - len(stdout)))
+        stdout, stderr = clip_middle(stdout, room - err_room), clip_middle(stderr, err_room)
+    if stdout and stderr:
+        return stdout + "\n" + stderr
+    return stdout or stderr
 
 
 def execute_sandbox_tool(chat_id, tool_name, tool_input):
     """Execute a sandbox tool and return the result string."""
     if tool_name == "bash":
         stdout, stderr, code = sandbox_exec(
-            chat_id, ["bash", "-c", tool_input["command"]], timeout=60
+            chat_id, ["bash", "-c", tool_input["command"]], timeout=60, bounded=True
         )
-        output = stdout
-        if stderr:
-            output += ("\n" if output else "") + stderr
+        output = clip_output(stdout, stderr)
         if code != 0 and not output:
             output = f"Exit code: {code}"
         return output or "(no output)"
 
     elif tool_name == "read_file":
-        stdout, stderr, code = sandbox_exec(chat_id, ["cat", tool_input["path"]])
-        if code != 0:
-            return f"Error: {stderr.strip()}"
-        return stdout
+        content, error = read_sandbox_file(chat_id, tool_input["path"])
+        if error is not None:
+            return f"Error: {error}"
+        return content
 
     elif tool_name == "write_file":
         path = tool_input["path"]
         content = tool_input["content"]
-        safe_path = shlex.quote(path)
-        stdout, stderr, code = sandbox_exec(
-            chat_id,
-            ["sh", "-c", f"mkdir -p \"$(dirname {safe_path})\" && cat > {safe_path}"],
-            input_data=content,
-        )
-        if code != 0:
-            return f"Error: {stderr.strip()}"
+        error = write_sandbox_file(chat_id, path, content)
+        if error is not None:
+            return f"Error: {error}"
         return f"Wrote {len(content)} bytes to {path}"
 
     elif tool_name == "edit_file":
         path = tool_input["path"]
         old_string = tool_input["old_string"]
         new_string = tool_input["new_string"]
-        stdout, stderr, code = sandbox_exec(chat_id, ["cat", path])
-        if code != 0:
-            return f"Error reading {path}: {stderr.strip()}"
-        content = stdout
+        content, error = read_sandbox_file(chat_id, path)
+        if error is not None:
+            return f"Error reading {path}: {error}"
         if old_string not in content:
             return f"Error: old_string not found in {path}"
         count = content.count(old_string)
         if count > 1:
             return f"Error: old_string appears {count} times in {path}. Must be unique."
         new_content = content.replace(old_string, new_string, 1)
-        safe_path = shlex.quote(path)
-        stdout, stderr, code = sandbox_exec(
-            chat_id, ["sh", "-c", f"cat > {safe_path}"], input_data=new_content,
-        )
-        if code != 0:
-            return f"Error writing {path}: {stderr.strip()}"
+        error = write_sandbox_file(chat_id, path, new_content)
+        if error is not None:
+            return f"Error writing {path}: {error}"
         return f"Edited {path}"
 
     elif tool_name == "list_files":
         path = tool_input.get("path", ".")
         stdout, stderr, code = sandbox_exec(
-            chat_id, ["find", path, "-maxdepth", "3", "-not", "-path", "*/.*", "-not", "-name", ".*"]
+            chat_id, ["find", path, "-maxdepth", "3", "-not", "-path", "*/.*", "-not", "-name", ".*"],
+            bounded=True,
         )
         if code != 0 and stderr:
             return f"Error: {stderr.strip()}"
@@ -284,8 +1445,20 @@ def execute_sandbox_tool(chat_id, tool_name, tool_input):
     elif tool_name == "grep":
         pattern = tool_input["pattern"]
         path = tool_input.get("path", ".")
+        f = open_upper_file(chat_id, path)
+        if f:
+            try:
+                regex = re.compile(pattern.encode(), re.M)
+            except re.error as e:
+                f.close()
+                return f"Error: invalid pattern: {e}"
+            try:
+                return grep_file(regex, f, path) or "No matches found"
+            except OSError:
+                pass
+        flags = "-rnP" if grep_supports_perl(chat_id) else "-rnE"
         stdout, stderr, code = sandbox_exec(
-            chat_id, ["grep", "-rn", pattern, path]
+            chat_id, ["grep", flags, pattern, path], bounded=True
         )
         if code == 1:
             return "No matches found"
@@ -299,6 +1472,267 @@ def execute_sandbox_tool(chat_id, tool_name, tool_input):
 SANDBOX_TOOL_NAMES = {t["name"] for t in TOOLS if t["name"] != "run_js"}
 
 
+def chat_lock(chat_id):
+    with chat_locks_guard:
+        lock = chat_locks.get(chat_id)
+        if lock is None:
+            lock = chat_locks[chat_id] = threading.Lock()
+        return lock
+
+
+def run_sandbox_tools(chat_id, blocks, lock=None):
+    """Run sandbox tool blocks in order, holding lock (if given) for the batch."""
+    results = []
+    with lock or contextlib.nullcontext():
+        for block in blocks:
+            result = execute_sandbox_tool(chat_id, block["name"], block["input"])
+            if len(result) > TOOL_RESULT_LIMIT:
+                result = result[:TOOL_RESULT_LIMIT] + "\n... (truncated)"
+            results.append(result)
+    return results
+
+
+def start_sandbox_tools(chat_id, blocks):
+    """Start sandbox tool blocks on TOOL_POOL; returns a Future per block.
+
+    Consecutive safe tools run together; each unsafe tool runs alone, under
+    the chat's lock, once everything before it has finished, and nothing
+    after it starts until it has. The next group is submitted from the done
+    callback of the last task in the one before, so no pool worker ever sits
+    waiting on another tool.
+    """
+    groups = []
+    for i, block in enumerate(blocks):
+        if groups and block["name"] in CONCURRENCY_SAFE and blocks[groups[-1][0]]["name"] in CONCURRENCY_SAFE:
+            groups[-1].append(i)
+        else:
+            groups.append([i])
+    results = [Future() for _ in blocks]
+    counter_lock = threading.Lock()
+
+    def start(g):
+        if g == len(groups):
+            return
+        group = groups[g]
+        left = [len(group)]
+        lock = None if blocks[group[0]]["name"] in CONCURRENCY_SAFE else chat_lock(chat_id)
+        for i in group:
+            fut = TOOL_POOL.submit(run_sandbox_tools, chat_id, [blocks[i]], lock)
+            fut.add_done_callback(lambda fut, i=i, g=g, left=left: finish(fut, i, g, left))
+
+    def finish(fut, i, g, left):
+        # A failed tool doesn't stop the ones after it
+        if fut.exception() is not None:
+            results[i].set_exception(fut.exception())
+        else:
+            results[i].set_result(fut.result())
+        with counter_lock:
+            left[0] -= 1
+            done = left[0] == 0
+        if done:
+            start(g + 1)
+
+    start(0)
+    return results
+
+
+def expect_tool_result(tool_id):
+    """Register a run_js call before its js event goes out to the browser."""
+    if redis_client is None:
+        pending_futures[tool_id] = Future()
+
+
+def deliver_tool_result(tool_id, result):
+    if redis_client is not None:
+        key = f"tool:{tool_id}"
+        redis_client.pipeline().rpush(key, result).expire(key, REDIS_RESULT_TTL).execute()
+        return
+    future = pending_futures.get(tool_id)
+    if future and not future.done():
+        future.set_result(result)
+
+
+def discard_tool_results(tool_ids):
+    if redis_client is not None:
+        if tool_ids:
+            redis_client.delete(*[f"tool:{tool_id}" for tool_id in tool_ids])
+        return
+    for tool_id in tool_ids:
+        pending_futures.pop(tool_id, None)
+
+
+def wait_tool_result(tool_id, deadline):
+    """Block until the browser posts the run_js result; "OK" past the deadline.
+
+    deadline is a time.monotonic() value shared by all the run_js calls of a
+    turn, so a page that never answers costs TOOL_RESULT_TIMEOUT once rather
+    than once per call.
+    """
+    remaining = max(0.0, deadline - time.monotonic())
+    if redis_client is not None:
+        key = f"tool:{tool_id}"
+        try:
+            if remaining == 0:
+                # blpop treats a zero timeout as "wait forever"
+                result = redis_client.lpop(key)
+                return result if result is not None else "OK"
+            item = redis_client.blpop(key, timeout=remaining)
+            return item[1] if item else "OK"
+        finally:
+            # Drops a late or repeated post for this call
+            redis_client.delete(key)
+    future = pending_futures.get(tool_id)
+    if future is None:
+        return "OK"
+    try:
+        return future.result(timeout=remaining)
+    except FutureTimeout:
+        return "OK"
+    finally:
+        pending_futures.pop(tool_id, None)
+
+
+class AssistantTurn:
+    """State for one streamed assistant turn.
+
+    Each stream event is dispatched through EVENT_HANDLERS; a handler updates
+    the state and returns the SSE frame to send, if any. The finished content
+    blocks collect in `blocks`, and run_js calls sent to the browser in
+    `awaiting`. Text deltas are held in `pending_text` and sent in batches.
+    """
+
+    def __init__(self):
+        self.blocks = []
+        self.stop_reason = None
+        self.awaiting = set()
+        self.block_type = None
+        self.tool_name = None
+        self.tool_id = None
+        self.text_parts = []
+        self.pending_text = []
+        self.pending_chars = 0
+        self.last_flush = 0.0
+        self.tool_input_buf = bytearray()
+        self.tool_input_text = None
+
+    def on_block_start(self, event):
+        block = event.content_block
+        if block.type == "text":
+            self.block_type = "text"
+            self.text_parts = []
+            return TEXT_START_FRAME
+        if block.type == "tool_use":
+            self.block_type = "tool_use"
+            self.tool_name = block.name
+            self.tool_id = block.id
+            self.tool_input_buf = bytearray()
+            self.tool_input_text = JsonStringValues()
+            return sse({"type": "tool_start", "name": block.name, "tool_id": block.id})
+
+    def on_block_delta(self, event):
+        handler = self.DELTA_HANDLERS.get(event.delta.type)
+        if handler:
+            return handler(self, event.delta)
+
+    def on_text_delta(self, delta):
+        self.text_parts.append(delta.text)
+        self.pending_text.append(delta.text)
+        self.pending_chars += len(delta.text)
+        if self.pending_chars >= TEXT_FLUSH_CHARS \
+                or time.monotonic() - self.last_flush >= TEXT_FLUSH_SECONDS:
+            return self.flush_text()
+
+    def flush_text(self):
+        """The text_delta frame for the pending text, if there is any."""
+        if not self.pending_text:
+            return None
+        frame = text_delta_frame("".join(self.pending_text))
+        self.pending_text = []
+        self.pending_chars = 0
+        self.last_flush = time.monotonic()
+        return frame
+
+    def on_input_json_delta(self, delta):
+        self.tool_input_buf += delta.partial_json.encode()
+        if len(self.tool_input_buf) > MAX_TOOL_INPUT_BYTES:
+            raise ValueError(f"{self.tool_name} input exceeded {MAX_TOOL_INPUT_BYTES} bytes")
+        text = self.tool_input_text.feed(delta.partial_json)
+        if text:
+            return tool_delta_frame(text)
+
+    def on_block_stop(self, event):
+        frame = None
+        if self.block_type == "text":
+            self.blocks.append({"type": "text", "text": "".join(self.text_parts)})
+            frame = self.flush_text()
+        elif self.block_type == "tool_use":
+            tool_input = loads(self.tool_input_buf) if self.tool_input_buf else {}
+            self.blocks.append({
+                "type": "tool_use", "id": self.tool_id,
+                "name": self.tool_name, "input": tool_input,
+            })
+            if self.tool_name == "run_js":
+                code = tool_input.get("code", "")
+                if code:
+                    expect_tool_result(self.tool_id)
+                    self.awaiting.add(self.tool_id)
+                    frame = sse({"type": "js", "code": code, "tool_id": self.tool_id})
+        self.block_type = None
+        self.tool_name = None
+        return frame
+
+    def on_message_delta(self, event):
+        self.stop_reason = event.delta.stop_reason
+
+    EVENT_HANDLERS = {
+        "content_block_start": on_block_start,
+        "content_block_delta": on_block_delta,
+        "content_block_stop": on_block_stop,
+        "message_delta": on_message_delta,
+    }
+    DELTA_HANDLERS = {
+        "text_delta": on_text_delta,
+        "input_json_delta": on_input_json_delta,
+    }
+
+
+# Content block type -> the fields of it the API accepts back
+BLOCK_SERIALIZERS = {
+    "text": lambda b: {"type": "text", "text": b.text},
+    "tool_use": lambda b: {"type": "tool_use", "id": b.id, "name": b.name, "input": b.input},
+}
+
+
+def serialize_block(block):
+    try:
+        serializer = BLOCK_SERIALIZERS[block.type]
+    except KeyError:
+        raise ValueError(f"Unexpected content block type: {block.type}") from None
+    return serializer(block)
+
+
+def stream_assistant_turn(chat_id, messages, turn):
+    """Stream one assistant turn into turn, yielding SSE frames.
+
+    Use with `yield from`.
+    """
+    handlers = AssistantTurn.EVENT_HANDLERS
+    system, context = prune_messages(chat_id, messages)
+    with client.messages.stream(
+        **STREAM_KWARGS, system=system, messages=with_cache_breakpoints(context),
+    ) as stream:
+        for event in stream:
+            handler = handlers.get(event.type)
+            if handler:
+                frame = handler(turn, event)
+                if frame:
+                    yield frame
+        if turn.stop_reason is None:
+            final_message = stream.get_final_message()
+            turn.stop_reason = final_message.stop_reason
+            turn.blocks = list(map(serialize_block, final_message.content))
+
+
 @app.route("/")
 def index():
     return render_template("index.html")
@@ -317,44 +1751,52 @@ def picker():
 @app.route("/tool_result/<tool_id>", methods=["POST"])
 def receive_tool_result(tool_id):
     data = request.json
-    pending_results[tool_id] = data.get("result", "OK")
-    ev = pending_events.get(tool_id)
-    if ev:
-        ev.set()
+    deliver_tool_result(tool_id, data.get("result", "OK"))
     return jsonify({"status": "ok"})
 
 
 @app.route("/chats", methods=["GET"])
 def list_chats():
-    chats = []
-    for fname in os.listdir(CHATS_DIR):
-        if not fname.endswith(".json"):
-            continue
-        with open(os.path.join(CHATS_DIR, fname)) as f:
-            data = json.load(f)
-        chats.append({
-            "id": data["id"],
-            "title": data.get("title", "Untitled"),
-            "updated_at": data.get("updated_at", ""),
-        })
-    chats.sort(key=lambda c: c["updated_at"], reverse=True)
-    return jsonify({"chats": chats})
+    global listing_cache
+    # This process sees its own saves, but with REDIS_URL set other server
+    # processes write chats too, so then the directory is always rescanned.
+    if listing_cache is None or redis_client is not None:
+        refresh_index()
+    with index_lock:
+        if listing_cache is None:
+            chats = sorted(CHATS_INDEX.values(), key=lambda c: c["updated_at"], reverse=True)
+            body = dumps({"chats": chats})
+            listing_cache = (body, hashlib.md5(body).hexdigest())
+        body, etag = listing_cache
+    response = Response(body, mimetype="application/json")
+    response.set_etag(etag, weak=True)
+    response.cache_control.no_cache = True   # always revalidate, then 304
+    return response.make_conditional(request)
 
 
 @app.route("/chats/<chat_id>", methods=["GET"])
 def get_chat(chat_id):
-    path = chat_path(chat_id)
-    if not os.path.exists(path):
+    if chat_id not in CHATS_INDEX:
+        refresh_index()
+    meta = CHATS_INDEX.get(chat_id)
+    if meta is None:
         return jsonify({"error": "not found"}), 404
-    with open(path) as f:
-        return jsonify(json.load(f))
+    return json_response({**meta, "messages": load_messages(chat_id)})
 
 
 @app.route("/chats/<chat_id>", methods=["DELETE"])
 def delete_chat(chat_id):
-    path = chat_path(chat_id)
-    if os.path.exists(path):
-        os.remove(path)
+    for path in (chat_path(chat_id), legacy_chat_path(chat_id), summary_path(chat_id)):
+        if os.path.exists(path):
+            os.remove(path)
+    last_saved_index.pop(chat_id, None)
+    history_cache.pop(chat_id, None)
+    title_cache.pop(chat_id, None)
+    with index_lock:
+        CHATS_INDEX.pop(chat_id, None)
+        index_mtimes.pop(chat_id, None)
+        invalidate_listing()
+    persist_index()
     return jsonify({"status": "ok"})
 
 
@@ -364,99 +1806,74 @@ def chat():
     chat_id = request.json.get("chat_id")
 
     if not user_message:
-        return Response(
-            sse({"type": "error", "content": "Empty message."}) + sse({"type": "done"}),
-            mimetype="text/event-stream",
-        )
+        return Response(EMPTY_MESSAGE_SSE, mimetype="text/event-stream")
 
     if not chat_id:
         chat_id = uuid.uuid4().hex[:12]
 
-    messages = load_messages(chat_id)
+    with active_chats_lock:
+        busy = chat_id in active_chats
+        active_chats.add(chat_id)
+    if busy:
+        return Response(CHAT_BUSY_SSE, mimetype="text/event-stream")
+
+    released = False
+
+    def release():
+        # Runs after the save and again when the response closes; only the
+        # first may drop the claim, or it could drop the next request's
+        nonlocal released
+        with active_chats_lock:
+            if not released:
+                released = True
+                active_chats.discard(chat_id)
+
+    try:
+        messages = load_messages(chat_id)
+    except BaseException:
+        release()
+        raise
     messages.append({"role": "user", "content": user_message})
 
     def generate():
+        turn = None
         try:
             while True:
-                current_block_type = None
-                current_tool_name = None
-                tool_id = None
-                tool_input_parts = []
-                stop_reason = None
-
-                with client.messages.stream(
-                    model="claude-opus-4-6",
-                    max_tokens=16000,
-                    system=SYSTEM_PROMPT,
-                    tools=TOOLS,
-                    messages=messages,
-                ) as stream:
-                    for event in stream:
-                        if event.type == "content_block_start":
-                            if event.content_block.type == "text":
-                                current_block_type = "text"
-                                yield sse({"type": "text_start"})
-                            elif event.content_block.type == "tool_use":
-                                current_block_type = "tool_use"
-                                current_tool_name = event.content_block.name
-                                tool_id = event.content_block.id
-                                tool_input_parts = []
-                                yield sse({"type": "tool_start", "name": current_tool_name})
-
-                        elif event.type == "content_block_delta":
-                            if event.delta.type == "text_delta":
-                                yield sse({"type": "text_delta", "content": event.delta.text})
-                            elif event.delta.type == "input_json_delta":
-                                tool_input_parts.append(event.delta.partial_json)
-                                yield sse({"type": "tool_delta", "content": event.delta.partial_json})
-
-                        elif event.type == "content_block_stop":
-                            if current_block_type == "tool_use" and tool_input_parts:
-                                tool_input = json.loads("".join(tool_input_parts))
-                                if current_tool_name == "run_js":
-                                    code = tool_input.get("code", "")
-                                    if code:
-                                        pending_events[tool_id] = threading.Event()
-                                        yield sse({"type": "js", "code": code, "tool_id": tool_id})
-                            current_block_type = None
-                            current_tool_name = None
-
-                        elif event.type == "message_delta":
-                            stop_reason = event.delta.stop_reason
-
-                    final_message = stream.get_final_message()
-
-                messages.append({
-                    "role": "assistant",
-                    "content": [serialize_block(b) for b in final_message.content],
-                })
-
-                if stop_reason == "end_turn":
+                turn = AssistantTurn()
+                yield from stream_assistant_turn(chat_id, messages, turn)
+                messages.append({"role": "assistant", "content": turn.blocks})
+
+                if turn.stop_reason == "end_turn":
                     break
 
-                tool_results = []
-                for block in final_message.content:
-                    if block.type != "tool_use":
-                        continue
-                    if block.name == "run_js":
-                        ev = pending_events.get(block.id)
-                        if ev:
-                            ev.wait(timeout=30)
-                        result = pending_results.pop(block.id, "OK")
-                        pending_events.pop(block.id, None)
-                    elif block.name in SANDBOX_TOOL_NAMES:
-                        result = execute_sandbox_tool(chat_id, block.name, block.input)
-                        if len(result) > 10000:
-                            result = result[:10000] + "\n... (truncated)"
-                        yield sse({"type": "tool_output", "name": block.name, "tool_id": block.id, "result": result})
-                    else:
-                        result = f"Error: Unknown tool {block.name}"
+                tool_blocks = [b for b in turn.blocks if b["type"] == "tool_use"]
+                results = [None] * len(tool_blocks)
+
+                # Start sandbox tools before waiting on the browser so both
+                # kinds of tool overlap
+                sandbox = [i for i, block in enumerate(tool_blocks) if block["name"] in SANDBOX_TOOL_NAMES]
+                futures = {
+                    fut: [i] for fut, i in
+                    zip(start_sandbox_tools(chat_id, [tool_blocks[i] for i in sandbox]), sandbox)
+                }
+
+                deadline = time.monotonic() + TOOL_RESULT_TIMEOUT
+                for i, block in enumerate(tool_blocks):
+                    if block["name"] == "run_js":
+                        results[i] = wait_tool_result(block["id"], deadline) if block["id"] in turn.awaiting else "OK"
+                    elif block["name"] not in SANDBOX_TOOL_NAMES:
+                        results[i] = f"Error: Unknown tool {block['name']}"
 
-                    tool_results.append({
-                        "type": "tool_result",
-                        "tool_use_id": block.id,
-                        "content": result,
-                    })
+                for fut in as_completed(futures):
+                    for i, result in zip(futures[fut], fut.result()):
+                        block = tool_blocks[i]
+                        results[i] = result
+                        yield sse({"type": "tool_output", "name": block["name"], "tool_id": block["id"], "result": result})
+
+                tool_results = [
+                    {"type": "tool_result", "tool_use_id": block["id"], "content": result}
+                    for block, result in zip(tool_blocks, results)
+                ]
 
                 if tool_results:
                     messages.append({"role": "user", "content": tool_results})
@@ -465,14 +1882,26 @@ def chat():
 
         except Exception as e:
             yield sse({"type": "error", "content": str(e)})
+        finally:
+            # Drop run_js calls the turn never got to wait on, whether it
+            # failed or the client went away (GeneratorExit)
+            if turn is not None:
+                discard_tool_results(turn.awaiting)
 
-        save_chat(chat_id, messages)
+        try:
+            save_chat(chat_id, messages)
+        finally:
+            release()
         yield sse({"type": "done", "chat_id": chat_id})
 
-    return Response(generate(), mimetype="text/event-stream", headers={
-        "Cache-Control": "no-cache",
+    response = Response(generate(), mimetype="text/event-stream", headers={
+        # no-transform keeps proxies from compressing (and so buffering) the stream
+        "Cache-Control": "no-cache, no-transform",
         "X-Accel-Buffering": "no",
     })
+    # Also covers a client that goes away before the stream finishes
+    response.call_on_close(release)
+    return response
 
 
 @app.route("/reset", methods=["POST"])
@@ -480,5 +1909,19 @@ def reset():
     return jsonify({"status": "ok", "chat_id": uuid.uuid4().hex[:12]})
 
 
+load_index()
+
+
 if __name__ == "__main__":
-    app.run(debug=True, host="0.0.0.0", port=5000)
+    if "--dev" in sys.argv or shutil.which("gunicorn") is None:
+        app.run(debug=True, host="0.0.0.0", port=5000, threaded=True)
+    else:
+        # Every open chat stream holds a worker thread, so give them plenty;
+        # a worker stalls run_js results once they are all taken (see README).
+        # Timeout 0: streams are long-lived and mustn't get the worker killed.
+        # More than one worker needs REDIS_URL (see README).
+        os.execvp("gunicorn", [
+            "gunicorn", "--chdir", os.path.dirname(os.path.abspath(__file__)),
+            "-k", "gthread", "-w", os.environ.get("WEB_CONCURRENCY", "1"),
+            "--threads", "64", "--timeout", "0", "-b", "0.0.0.0:5000", "app:app",
+        ])